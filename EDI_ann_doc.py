@@ -1,20 +1,58 @@
 from annotation_docs import EDIRAnn, relocate_annotation_pos
 import logging
 from os.path import basename, isfile, join, split
-import xml.etree.ElementTree as ET
 import re
+try:
+    # libxml2 backed parser, same ElementTree API as the standard library one
+    from lxml import etree as ET
+    _parser_options = {'remove_blank_text': True}
+except ImportError:
+    import xml.etree.ElementTree as ET
+    _parser_options = {}
+
+
+def _compile_path(path):
+    """
+    compile an element path once - an XPath object with lxml, a findall call otherwise
+    """
+    if hasattr(ET, 'XPath'):
+        return ET.XPath(path)
+    return lambda e: e.findall(path)
+
+
+_XP_P = _compile_path('.//p')
+_XP_CLASS_MENTIONS = _compile_path('.//classMention')
+_XP_MENTION_CLASS = _compile_path('./mentionClass')
+_XP_MENTION_PARENTS = _compile_path('.//mention/..')
+_XP_SPAN = _compile_path('./span')
+_XP_SPANNED_TEXT = _compile_path('./spannedText')
+
+
+def _index_mentions(root):
+    """
+    map each mention id to the (first) element containing it, replacing a tree search per mention
+    """
+    id2parent = {}
+    for parent in _XP_MENTION_PARENTS(root):
+        for m in parent:
+            if m.tag == 'mention' and 'id' in m.attrib:
+                id2parent.setdefault(m.attrib['id'], parent)
+    return id2parent
 
 
 class EDIRDoc(object):
     """
     a class for reading EDIR annotation doc (XML)
     """
+    # words and entities are released once read; set to True by subclasses working on the parsed tree
+    _keep_tree = False
 
     def __init__(self, file_path):
         self._path = file_path
         self._root = None
         self._full_text = None
         self._word_offset_start = -1
+        self._ent_parts = []
         self._entities = None
         self.load()
 
@@ -23,71 +61,79 @@ class EDIRDoc(object):
         return self._path
 
     def load(self):
+        """
+        parse the doc in one pass, collecting the full text, the word offset start and the
+        standoff entities on the way
+        """
         if not isfile(self.file_path):
             logging.debug('%s is NOT a file' % self.file_path)
             return
-        tree = ET.parse(self.file_path)
-        self._root = tree.getroot()
-        self.get_word_offset_start()
+        text = []
+        text_len = 0
+        start_offset = -1
+        ent_parts = []
+        path = []
+        for event, elem in ET.iterparse(self.file_path, events=('start', 'end'), **_parser_options):
+            if event == 'start':
+                path.append(elem)
+                continue
+            path.pop()
+            if len(path) < 2:
+                if len(path) == 0:
+                    self._root = elem
+                continue
+            parent, grand_parent = path[-1], path[-2]
+            if elem.tag == 'w' and parent.tag == 's' and grand_parent.tag == 'p' and 'proc' in parent.attrib:
+                # and s.attrib['proc'] == 'yes':
+                if 'id' not in elem.attrib:
+                    continue
+                id_val = int(elem.attrib['id'][1:])
+                if start_offset == -1:
+                    start_offset = id_val
+                offset = id_val - start_offset
+                text.append(' ' * (offset - text_len) + elem.text)
+                text_len = max(offset, text_len) + len(elem.text)
+            elif elem.tag == 'ent' and parent.tag == 'ents' and grand_parent.tag == 'standoff':
+                if 'type' in elem.attrib:
+                    ent_parts.append((elem.attrib['type'], [(part.text, part.attrib['sw'])
+                                                            for parts in elem if parts.tag == 'parts'
+                                                            for part in parts if part.tag == 'part']))
+            else:
+                continue
+            if not self._keep_tree:
+                elem.clear()
+        self._full_text = ''.join(text)
+        self._word_offset_start = start_offset
+        self._ent_parts = ent_parts
 
     @property
     def get_full_text(self):
-        if self._full_text is not None:
-            return self._full_text
-        if self._root is None:
+        if self._full_text is None:
             self.load()
-        root = self._root
-        d = ''
-        start_offset = -1
-        for p in root.findall('.//p'):
-            for s in p:
-                if 'proc' in s.attrib:  # and s.attrib['proc'] == 'yes':
-                    for w in s:
-                        id_val = int(w.attrib['id'][1:])
-                        if start_offset == -1:
-                            start_offset = id_val
-                        offset = id_val - start_offset
-                        d += ' ' * (offset - len(d)) + w.text
-        self._full_text = d
-        return d
+        return self._full_text
 
     def get_word_offset_start(self):
-        if self._word_offset_start >= 0:
-            return self._word_offset_start
-        root = self._root
-        offset_start = -1
-        for e in root.findall('.//p/s[@proc]/w'):
-            if 'id' not in e.attrib:
-                continue
-            else:
-                offset_start = int(e.attrib['id'][1:])
-                break
-        # if offset_start == -1:
-        #     logging.debug('%s offset start could not be found' % self.file_path)
-        self._word_offset_start = offset_start
+        return self._word_offset_start
 
     def get_ess_entities(self):
         if self._entities is not None:
             return self._entities
-        root = self._root
         offset_start = self.get_word_offset_start()
         entities = []
-        for e in root.findall('.//standoff/ents/ent'):
-            if 'type' not in e.attrib:
-                continue
-            ent_type = e.attrib['type']
+        for ent_type, parts in self._ent_parts:
             if ent_type.startswith('label:'):
                 continue
             negated = False
             if 'neg_' in ent_type:
                 negated = True
                 ent_type = ent_type.replace(r'neg_', '')
-            str = ' '.join([part.text for part in e.findall('./parts/part')])
+            str = ' '.join([t for t, sw in parts])
             ent_start = -1
             ent_end = -1
-            for part in e.findall('./parts/part'):
-                ent_start = int(part.attrib['sw'][1:]) - offset_start
-                ent_end = ent_start + len(part.text)
+            if len(parts) > 0:
+                t, sw = parts[-1]
+                ent_start = int(sw[1:]) - offset_start
+                ent_end = ent_start + len(t)
             ann = EDIRAnn(str=str, start=ent_start, end=ent_end, type=ent_type)
             ann.negated = negated
             ann.id = len(entities)
@@ -113,27 +159,28 @@ class eHostGenedDoc(EDIRDoc):
             return self._entities
         root = self._root
         entities = []
-        s_e_ids = []
-        for e in root.findall('.//classMention'):
-            mcs = e.findall('./mentionClass')
+        s_e_ids = set()
+        id2mention = _index_mentions(root)
+        for e in _XP_CLASS_MENTIONS(root):
+            mcs = _XP_MENTION_CLASS(e)
             mention_id = e.attrib['id']
             if len(mcs) > 0:
                 mc = mcs[0]
                 cls = mc.attrib['id']
                 cls = cls.replace('Negated_', '').replace('hypothetical_', '').replace('Other_', '').replace(
                     'historical_', '')
-                mentions = root.findall('.//mention[@id="' + mention_id + '"]/..')
-                if len(mentions) > 0:
-                    span = mentions[0].findall('./span')
+                mention = id2mention.get(mention_id)
+                if mention is not None:
+                    span = _XP_SPAN(mention)
                     ent_start = span[0].attrib['start']
                     ent_end = span[0].attrib['end']
 
                     s_e_id = '%s-%s' % (ent_start, ent_end)
                     if s_e_id in s_e_ids:
                         continue
-                    s_e_ids.append(s_e_id)
+                    s_e_ids.add(s_e_id)
 
-                    spannedText = mentions[0].findall('./spannedText')
+                    spannedText = _XP_SPANNED_TEXT(mention)
                     str = spannedText[0].text
                     ann = EDIRAnn(str=str, start=int(ent_start), end=int(ent_end), type=cls)
                     ann.id = len(entities)
@@ -151,20 +198,21 @@ class eHostDoc(EDIRDoc):
             return self._entities
         root = self._root
         entities = []
-        for e in root.findall('.//classMention'):
-            mcs = e.findall('./mentionClass')
+        id2mention = _index_mentions(root)
+        for e in _XP_CLASS_MENTIONS(root):
+            mcs = _XP_MENTION_CLASS(e)
             mention_id = e.attrib['id']
             if len(mcs) > 0:
                 mc = mcs[0]
                 m = re.match(r'Verified\_([^\(]+)(\(.*\)){0,1}', mc.attrib['id'])
                 if m is not None:
                     cls = m.group(1)
-                    mentions = root.findall('.//mention[@id="' + mention_id + '"]/..')
-                    if len(mentions) > 0:
-                        span = mentions[0].findall('./span')
+                    mention = id2mention.get(mention_id)
+                    if mention is not None:
+                        span = _XP_SPAN(mention)
                         ent_start = span[0].attrib['start']
                         ent_end = span[0].attrib['end']
-                        spannedText = mentions[0].findall('./spannedText')
+                        spannedText = _XP_SPANNED_TEXT(mention)
                         str = spannedText[0].text
                         ann = EDIRAnn(str=str, start=int(ent_start), end=int(ent_end), type=cls)
                         ann.id = len(entities)
@@ -178,6 +226,8 @@ class ConllDoc(EDIRDoc):
     for Conll output from classification results
     """
 
+    _keep_tree = True
+
     def __init__(self, file_path):
         super(ConllDoc, self).__init__(file_path)
         self._tokens = None
@@ -206,7 +256,7 @@ class ConllDoc(EDIRDoc):
         root = self._root
         work_ess = list(self.get_ess_entities())
         matched_ess = set()
-        for p in root.findall('.//p'):
+        for p in _XP_P(root):
             for s in p:
                 if 'proc' in s.attrib:  # and s.attrib['proc'] == 'yes':
                     for w in s:
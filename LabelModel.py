@@ -1,9 +1,16 @@
 import logging
 from os.path import isfile, join
-from os import listdir
+from os import listdir, stat
+from functools import lru_cache
+from io import BytesIO
 from annotation_docs import Concept2Mapping, CustomisedRecoginiser
 from EDI_ann_doc import EDIRDoc, eHostGenedDoc
 import joblib as jl
+import pickle
+import numpy
+import utils
+
+_DUMP_KW = dict(compress=0, protocol=pickle.HIGHEST_PROTOCOL)
 
 
 class LabelModel(object):
@@ -24,10 +31,21 @@ class LabelModel(object):
         self._fps = 0
         self._lbl_one_dimension = True
         self._lbl2tfidf_dims = {}
+        self._lbl2tfidf_index = {}
         self._label_dimensions = []
+        self._label_dim_index = {}
+        self._context_dim_index = {}
         self._rare_labels = {}
         self._lbl2classifiers = {}
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # models serialised before the dimension indices existed only carry the lists
+        self._label_dim_index = {v: i for i, v in enumerate(self._label_dimensions)}
+        self._context_dim_index = {lbl: {v: i for i, v in enumerate(self._lbl_data[lbl]['dims'])}
+                                   for lbl in self._lbl_data}
+        self._lbl2tfidf_index = {}
+
     @property
     def concept_mapping(self):
         return self._concept_mapping
@@ -69,8 +87,10 @@ class LabelModel(object):
         return self._label
 
     def add_label_dimension(self, value):
-        if value.lower() not in self._label_dimensions:
-            self._label_dimensions.append(value.lower())
+        v = value.lower()
+        if v not in self._label_dim_index:
+            self._label_dim_index[v] = len(self._label_dimensions)
+            self._label_dimensions.append(v)
             # if tp is not None:
             #     self._tp_labels.add(value.lower())
             # if fp is not None:
@@ -82,19 +102,18 @@ class LabelModel(object):
     def add_context_dimension(self, value, tp=None, fp=None, lbl='united'):
         if lbl not in self._lbl_data:
             self._lbl_data[lbl] = {'dims': [], 't2f': {}, 'tps': set(), 'fps': set()}
+            self._context_dim_index[lbl] = {}
         d = self._lbl_data[lbl]
-        if value.lower() not in d['dims']:
-            d['dims'].append(value.lower())
-        if value.lower() not in d['t2f']:
-            d['t2f'][value.lower()] = 1
-        else:
-            d['t2f'][value.lower()] = d['t2f'][value.lower()] + 1
-        tps = d['tps']
-        fps = d['fps']
+        dim_index = self._context_dim_index[lbl]
+        v = value.lower()
+        if v not in dim_index:
+            dim_index[v] = len(d['dims'])
+            d['dims'].append(v)
+        d['t2f'][v] = d['t2f'].get(v, 0) + 1
         if tp is not None:
-            tps.add(value.lower())
+            d['tps'].add(v)
         if fp is not None:
-            fps.add(value.lower())
+            d['fps'].add(v)
 
     def add_context_dimension_by_annotation(self, ann, tp=None, fp=None, lbl=None):
         self.add_context_dimension(LabelModel.get_ann_dim_label(ann, generalise=True, no_negation=True), tp=tp, fp=fp,
@@ -124,25 +143,42 @@ class LabelModel(object):
         idf_weight = 1.0
         if len(tps) > 0 and len(fps) > 0:
             idf_weight = 1.0 * len(tps) / len(fps)
-        df = []
-        max_score = 0
-        for l in d['t2f']:
-            idf = 1.0 / ((1 if l in d['tps'] else 0) + (1 if l in d['fps'] else 0))
-            score = 1.0 * d['t2f'][l] / (len(tps) + len(fps))
-            if idf_weight == 1 or (l in d['tps'] and l in d['fps']):
-                score = score * idf
-                # if l in d['tps'] and l in d['fps']:
-                #     score *= 0.5
-            elif l in d['fps']:
-                score *= idf_weight * idf
-            max_score = max(score, max_score)
-            df.append((l, score))
-        df = sorted(df, key=lambda x: -x[1])
+        labels = list(d['t2f'])
+        freqs = numpy.array([d['t2f'][l] for l in labels], dtype=numpy.float64)
+        in_tps = numpy.array([l in tps for l in labels], dtype=bool)
+        in_fps = numpy.array([l in fps for l in labels], dtype=bool)
+        idf = 1.0 / (in_tps.astype(numpy.float64) + in_fps.astype(numpy.float64))
+        scores = freqs / (len(tps) + len(fps))
+        if idf_weight == 1:
+            scores = scores * idf
+        else:
+            # if l in d['tps'] and l in d['fps']:
+            #     score *= 0.5
+            scores = numpy.where(in_tps & in_fps, scores * idf,
+                                 numpy.where(in_fps, scores * (idf_weight * idf), scores))
+        max_score = max(float(scores.max()), 0) if len(labels) > 0 else 0
+        # only the scores no lower than the k-th largest need ordering, ties keep insertion order
+        candidates = numpy.arange(len(labels))
+        # no limit keeps all dims
+        k = len(labels) if k is None else k
+        if 0 < k < len(labels):
+            kth_score = numpy.partition(scores, len(labels) - k)[len(labels) - k]
+            candidates = numpy.nonzero(scores >= kth_score)[0]
+        top = candidates[numpy.argsort(-scores[candidates], kind='stable')][:k]
         # logging.debug(df)
-        self._lbl2tfidf_dims[lbl] = [(t[0], t[1] * 1.0 / max_score) for t in df[:k]]
+        self._lbl2tfidf_dims[lbl] = [(labels[i], float(scores[i]) * 1.0 / max_score) for i in top]
         logging.debug('%s ==> [%s]' % (lbl, self._lbl2tfidf_dims[lbl]))
         return self._lbl2tfidf_dims[lbl]
 
+    def get_top_tfidf_dimension_index(self, lbl='united'):
+        """
+        position of each selected tfidf dimension in the encoded feature vector
+        """
+        if lbl not in self._lbl2tfidf_index:
+            self._lbl2tfidf_index[lbl] = {t[0]: i for i, t in
+                                          enumerate(self.get_top_tfidf_dimensions(self.max_dimensions, lbl=lbl))}
+        return self._lbl2tfidf_index[lbl]
+
     @property
     def max_dimensions(self):
         return self._max_dimensions
@@ -164,127 +200,153 @@ class LabelModel(object):
         return self._lbl_data[lbl]['dims']
 
     def encode_ann(self, ann, context_anns, lbl='united', extra_dims=None):
-        ann_label = LabelModel.get_ann_dim_label(ann)
-        encoded = []
         # if self.use_one_dimension_for_label:
-        #     if ann_label in self.label_dimensions:
-        #         encoded.append(self.label_dimensions.index(ann_label))
-        #     else:
-        #         encoded.append(-1)
+        #     encoded.append(self._label_dim_index.get(LabelModel.get_ann_dim_label(ann), -1))
         # else:
-        #     for l in self.label_dimensions:
-        #         if l == ann_label:
-        #             encoded.append(1)
-        #         else:
-        #             encoded.append(0)
-        context_labels = [LabelModel.get_ann_dim_label(ann, generalise=True, no_negation=True) for ann in context_anns]
-        for l, score in self.get_top_tfidf_dimensions(self.max_dimensions, lbl=lbl):  # self.context_dimensions:
-            # freq = 0
-            # for cl in context_labels:
-            #     if cl.lower() == l.lower():
-            #         freq += 1
-            if l in context_labels:
-                encoded.append(1)
-            else:
-                encoded.append(0)
-            # encoded.append(freq * score)
-        return encoded + ([] if extra_dims is None else extra_dims)
-
-    def collect_dimensions(self, ann_dir):
-        cm = self.concept_mapping
+        #     one-hot over self.label_dimensions
+        dim_index = self.get_top_tfidf_dimension_index(lbl)
+        extra_dims = [] if extra_dims is None else extra_dims
+        encoded = numpy.zeros(len(dim_index) + len(extra_dims), dtype=numpy.int8)
+        # only the label lookups need python, the bits are set in one go
+        hits = [dim_index.get(LabelModel.get_ann_dim_label(c, generalise=True, no_negation=True))
+                for c in context_anns]
+        encoded[[i for i in hits if i is not None]] = 1
+        encoded[len(dim_index):] = extra_dims
+        return encoded
+
+    def collect_dimensions(self, ann_dir, n_jobs=-1):
         file_keys = [f.split('.')[0] for f in listdir(ann_dir) if isfile(join(ann_dir, f))]
-        # collect dimension labels
-        for fk in file_keys:
-            cr = CustomisedRecoginiser(join(ann_dir, '%s.json' % fk), cm)
-            t = self.label.replace('neg_', '')
-            anns = cr.get_anns_by_label(t)
-            neg_anns = cr.get_anns_by_label('neg_' + t)
-            for a in anns + neg_anns:
-                self.add_label_dimension_by_annotation(a)
-                # self.add_context_dimension_by_annotation(a)
-                if (a.negation != 'Negated' and self.label.startswith('neg_')) or \
-                        (a.negation == 'Negated' and not self.label.startswith('neg_')):
-                    continue
-                sanns = cr.get_same_sentence_anns(a)
-                context_anns = [] + sanns['umls'] + sanns['phenotype']
-                # collect cui labels
-                for u in sanns['umls']:
-                    self._cui2label[u.cui] = u.pref
-                for c in context_anns:
-                    self.add_context_dimension_by_annotation(c)
+        # collect dimension labels, docs are read in parallel and merged in file order
+        for label_dims, context_dims, cui2label in self.read_docs(LabelModel.read_dimension_doc, (ann_dir,),
+                                                                  file_keys, n_jobs=n_jobs):
+            for d in label_dims:
+                self.add_label_dimension(d)
+            self._cui2label.update(cui2label)
+            for d in context_dims:
+                self.add_context_dimension(d, lbl=None)
+
+    @staticmethod
+    def read_dimension_doc(label_model, ann_dir, fk):
+        """
+        dimension labels of one doc for collect_dimensions
+        :return: (label dimensions, context dimensions, [(cui, pref)])
+        """
+        cr = CustomisedRecoginiser(join(ann_dir, '%s.json' % fk), label_model.concept_mapping)
+        t = label_model.label.replace('neg_', '')
+        anns = cr.get_anns_by_label(t)
+        neg_anns = cr.get_anns_by_label('neg_' + t)
+        label_dims = []
+        context_dims = []
+        cui2label = []
+        for a in anns + neg_anns:
+            label_dims.append(LabelModel.get_ann_dim_label(a, no_negation=True))
+            # self.add_context_dimension_by_annotation(a)
+            if (a.negation != 'Negated' and label_model.label.startswith('neg_')) or \
+                    (a.negation == 'Negated' and not label_model.label.startswith('neg_')):
+                continue
+            sanns = cr.get_same_sentence_anns(a)
+            context_anns = [] + sanns['umls'] + sanns['phenotype']
+            # collect cui labels
+            for u in sanns['umls']:
+                cui2label.append((u.cui, u.pref))
+            for c in context_anns:
+                context_dims.append(LabelModel.get_ann_dim_label(c, generalise=True, no_negation=True))
+        return label_dims, context_dims, cui2label
 
     def collect_tfidf_dimensions(self, ann_dir, gold_dir, ignore_context=False, separate_by_label=False,
-                                 full_text_dir=None, eHostGD=False):
-        cm = self.concept_mapping
+                                 full_text_dir=None, eHostGD=False, n_jobs=-1):
         file_keys = [f[:f.rfind('.')] for f in listdir(ann_dir) if isfile(join(ann_dir, f))]
-        # collect dimension labels
+        # collect dimension labels, docs are read in parallel and merged in file order
         tp_freq = 0
         fp_freq = 0
-        label_type = self.label.replace('neg_', '')
         fn_freq = 0
-        for fk in file_keys:
-            cr = CustomisedRecoginiser(join(ann_dir, '%s.json' % fk), cm)
-            fk = fk.replace('se_ann_', '')
-            if full_text_dir is not None:
-                cr.full_text_folder = full_text_dir
-            if eHostGD:
-                if not isfile(join(gold_dir, '%s.txt.knowtator.xml' % fk)):
-                    continue
-                gd = eHostGenedDoc(join(gold_dir, '%s.txt.knowtator.xml' % fk))
-            else:
-                if not isfile(join(gold_dir, '%s-ann.xml' % fk)):
-                    continue
-                gd = EDIRDoc(join(gold_dir, '%s-ann.xml' % fk))
-            t = self.label.replace('neg_', '')
-            anns = cr.get_anns_by_label(t)
-            neg_anns = cr.get_anns_by_label('neg_' + t)
-
-            # re-segement sentences
-            # cr.re_segment_sentences(fk)
-            # cr.relocate_all_anns(fk)
-            # gd.relocate_anns(cr.get_full_text(fk))
-
-            not_matched_gds = []
-            for e in gd.get_ess_entities():
-                if (ignore_context and e.label.replace('neg_', '') == label_type) \
-                        or (not ignore_context and e.label == self.label):
-                    not_matched_gds.append(e.id)
-            for a in anns + neg_anns:
-                # self.add_context_dimension_by_annotation(a)
-                self.add_label_dimension_by_annotation(a)
-                # if (not ignore_context) and ((a.negation != 'Negated' and self.label.startswith('neg_')) or \
-                #         (a.negation == 'Negated' and not self.label.startswith('neg_'))):
-                #     logging.info('skipped because context')
-                #     continue
-
-                matched = False
-                for g in gd.get_ess_entities():
-                    if g.id in not_matched_gds:
-                        gt = g.label.replace('neg_', '')
-                        if g.overlap(a) and ((g.label == self.label and not ignore_context) or
-                                             (ignore_context and gt == label_type)):
-                            matched = True
-                            tp_freq += 1
-                            not_matched_gds.remove(g.id)
-                if not matched:
-                    fp_freq += 1
-
-                sanns = cr.get_prior_anns(a, contenxt_depth=-1)
-                context_anns = [] + sanns['umls'] + sanns['phenotype'] + cr.get_context_words(a, fk)
-                # context_anns =  cr.get_context_words(a, fk)
-                # collect cui labels
-                for u in sanns['umls']:
-                    self._cui2label[u.cui] = u.pref
-                for c in context_anns:
-                    self.add_context_dimension_by_annotation(c, tp=True if matched else None,
-                                                             fp=True if not matched else None,
-                                                             lbl='united' if not separate_by_label else
-                                                             LabelModel.get_ann_query_label(a))
-            fn_freq += len(not_matched_gds)
+        for r in self.read_docs(LabelModel.read_tfidf_doc, (ann_dir, gold_dir), file_keys, n_jobs=n_jobs,
+                                ignore_context=ignore_context, separate_by_label=separate_by_label,
+                                full_text_dir=full_text_dir, eHostGD=eHostGD):
+            if r is None:
+                continue
+            for d in r['label_dims']:
+                self.add_label_dimension(d)
+            self._cui2label.update(r['cui2label'])
+            for d, matched, lbl in r['context_dims']:
+                self.add_context_dimension(d, tp=True if matched else None, fp=True if not matched else None,
+                                           lbl=lbl)
+            tp_freq += r['tp']
+            fp_freq += r['fp']
+            fn_freq += r['fn']
         self._tps = tp_freq
         self._fps = fp_freq
         logging.debug('tp: %s, fp: %s, fn: %s' % (tp_freq, fp_freq, fn_freq))
 
+    @staticmethod
+    def read_tfidf_doc(label_model, ann_dir, gold_dir, fk, ignore_context=False, separate_by_label=False,
+                       full_text_dir=None, eHostGD=False):
+        """
+        match one doc against its gold standard for collect_tfidf_dimensions
+        :return: None if the gold standard doc does not exist, otherwise dimension labels, (cui, pref) pairs
+        and tp/fp/fn counts of the doc
+        """
+        cr = CustomisedRecoginiser(join(ann_dir, '%s.json' % fk), label_model.concept_mapping)
+        fk = fk.replace('se_ann_', '')
+        if full_text_dir is not None:
+            cr.full_text_folder = full_text_dir
+        if eHostGD:
+            if not isfile(join(gold_dir, '%s.txt.knowtator.xml' % fk)):
+                return None
+            gd = eHostGenedDoc(join(gold_dir, '%s.txt.knowtator.xml' % fk))
+        else:
+            if not isfile(join(gold_dir, '%s-ann.xml' % fk)):
+                return None
+            gd = EDIRDoc(join(gold_dir, '%s-ann.xml' % fk))
+        label = label_model.label
+        label_type = label.replace('neg_', '')
+        anns = cr.get_anns_by_label(label_type)
+        neg_anns = cr.get_anns_by_label('neg_' + label_type)
+
+        # re-segement sentences
+        # cr.re_segment_sentences(fk)
+        # cr.relocate_all_anns(fk)
+        # gd.relocate_anns(cr.get_full_text(fk))
+
+        ret = {'label_dims': [], 'context_dims': [], 'cui2label': [], 'tp': 0, 'fp': 0, 'fn': 0}
+        not_matched_gds = []
+        for e in gd.get_ess_entities():
+            if (ignore_context and e.label.replace('neg_', '') == label_type) \
+                    or (not ignore_context and e.label == label):
+                not_matched_gds.append(e.id)
+        for a in anns + neg_anns:
+            # self.add_context_dimension_by_annotation(a)
+            ret['label_dims'].append(LabelModel.get_ann_dim_label(a, no_negation=True))
+            # if (not ignore_context) and ((a.negation != 'Negated' and self.label.startswith('neg_')) or \
+            #         (a.negation == 'Negated' and not self.label.startswith('neg_'))):
+            #     logging.info('skipped because context')
+            #     continue
+
+            matched = False
+            for g in gd.get_ess_entities():
+                if g.id in not_matched_gds:
+                    gt = g.label.replace('neg_', '')
+                    if g.overlap(a) and ((g.label == label and not ignore_context) or
+                                         (ignore_context and gt == label_type)):
+                        matched = True
+                        ret['tp'] += 1
+                        not_matched_gds.remove(g.id)
+            if not matched:
+                ret['fp'] += 1
+
+            sanns = cr.get_prior_anns(a, contenxt_depth=-1)
+            context_anns = [] + sanns['umls'] + sanns['phenotype'] + cr.get_context_words(a, fk)
+            # context_anns =  cr.get_context_words(a, fk)
+            # collect cui labels
+            for u in sanns['umls']:
+                ret['cui2label'].append((u.cui, u.pref))
+            lbl = 'united' if not separate_by_label else LabelModel.get_ann_query_label(a)
+            for c in context_anns:
+                ret['context_dims'].append((LabelModel.get_ann_dim_label(c, generalise=True, no_negation=True),
+                                            matched, lbl))
+        ret['fn'] = len(not_matched_gds)
+        return ret
+
     def get_low_quality_labels(self, ann_dir, gold_dir, accurate_threshold=0.05, min_sample_size=20):
         return [t[0] for t in self.assess_label_quality(ann_dir, gold_dir)
                 if t[1] <= accurate_threshold and t[2] + t[3] >= min_sample_size]
@@ -340,7 +402,7 @@ class LabelModel(object):
         return sorted(lbls, key=lambda x: x[1])
 
     def load_data(self, ann_dir, gold_dir, verbose=True, ignore_mappings=[], ignore_context=False,
-                  separate_by_label=False, ful_text_dir=None, eHostGD=False, annotated_anns={}):
+                  separate_by_label=False, ful_text_dir=None, eHostGD=False, annotated_anns={}, n_jobs=-1):
         """
 
         :param ann_dir:
@@ -354,111 +416,49 @@ class LabelModel(object):
         :param annotated_anns: NB: this is for labelling settings where only partial data is annotated on
         the documents. Therefore, we need to filter out those not assessed by the annotators to avoid kill some
         true positives (those are correct but not assessed by annotators)
+        :param n_jobs: number of processes reading the docs (joblib convention, -1 for all CPUs)
         :return:
         """
         if ignore_context:
             logging.info('doing learning without considering contextual info')
         # print self.get_top_tfidf_dimensions(self.max_dimensions)
-        cm = self.concept_mapping
         file_keys = [f[:f.rfind('.')] for f in listdir(ann_dir) if isfile(join(ann_dir, f))]
+        doc_keys = file_keys
+        if len(annotated_anns) > 0:
+            doc_keys = [fk for fk in file_keys if '%s.txt' % fk.replace('se_ann_', '') in annotated_anns]
         lbl2data = {}
+        lbl2blocks = {}
         false_negatives = 0
-        lbl2tps = {}
-        label_type = self.label.replace('neg_', '')
         query_label_perform = {}
-        for fk in file_keys:
-            cr = CustomisedRecoginiser(join(ann_dir, '%s.json' % fk), cm)
-            fk = fk.replace('se_ann_', '')
-            if ful_text_dir is not None:
-                cr.full_text_folder = ful_text_dir
-            if eHostGD:
-                if not isfile(join(gold_dir, '%s.txt.knowtator.xml' % fk)):
-                    continue
-                # logging.debug('using GD file %s' % join(gold_dir, '%s.txt.knowtator.xml' % fk))
-                gd = eHostGenedDoc(join(gold_dir, '%s.txt.knowtator.xml' % fk))
-            else:
-                if not isfile(join(gold_dir, '%s-ann.xml' % fk)):
-                    continue
-                logging.debug('using GD file %s' % join(gold_dir, '%s-ann.xml' % fk))
-                gd = EDIRDoc(join(gold_dir, '%s-ann.xml' % fk))
-
-            # re-segement sentences
-            # cr.re_segment_sentences(fk)
-            # cr.relocate_all_anns(fk)
-            # gd.relocate_anns(cr.get_full_text(fk))
-
-            not_matched_gds = []
-            for e in gd.get_ess_entities():
-                if (ignore_context and e.label.replace('neg_', '') == label_type) \
-                        or (not ignore_context and e.label == self.label):
-                    not_matched_gds.append(e.id)
-
-            anns = cr.get_anns_by_label(self.label, ignore_mappings=ignore_mappings, no_context=ignore_context)
-            if len(annotated_anns) > 0:
-                if '%s.txt' % fk not in annotated_anns:
-                    continue
-                kept_anns = []
-                for a in anns:
-                    for aa in annotated_anns['%s.txt' % fk]:
-                        if int(aa['s']) == a.start and int(aa['e']) == a.end:
-                            kept_anns.append(a)
-                anns = kept_anns
-            for a in anns:
-                logging.debug('%s, %s, %s' % (a.str, a.start, a.end))
-                multiple_true_positives = 0
-                t2anns = cr.get_prior_anns(a)
-                # if len(t2anns['umls']) + len(t2anns['phenotype']) == 0:
-                #     t2anns = cr.get_prior_anns(a, contenxt_depth=-2)
-                context_anns = [] + t2anns['umls'] + t2anns['phenotype'] + \
-                               cr.get_context_words(a, fk)
-                # context_anns = cr.get_context_words(a, fk)
-                matched = False
-                for g in gd.get_ess_entities():
-                    if g.id in not_matched_gds:
-                        gt = g.label.replace('neg_', '')
-                        if g.overlap(a) and ((g.label == self.label and not ignore_context) or
-                                             (ignore_context and gt == label_type)):
-                            if matched:
-                                multiple_true_positives += 1
-                            matched = True
-                            not_matched_gds.remove(g.id)
-                if verbose:
-                    if not matched:
-                        logging.debug('%s %s %s' % ('!',
-                                                    self.get_ann_dim_label(a) +
-                                                    ' // ' + ' | '.join(self.get_ann_dim_label(a, generalise=True)
-                                                                        for a in context_anns), fk))
-                    else:
-                        logging.debug('%s %s %s' % ('R',
-                                                    self.get_ann_dim_label(a) + ' // ' + ' | '.join(
-                                                        self.get_ann_dim_label(a, generalise=True)
-                                                        for a in context_anns), fk))
-
-                lbl = LabelModel.get_label_specific_data(self, lbl2data, a, context_anns, fk, cr,
-                                                         separate_by_label=separate_by_label)
-
-                lbl2data[lbl]['multiple_tps'] += multiple_true_positives
-                Y = lbl2data[lbl]['Y']
-                Y.append([1 if matched else 0])
-                ql = lbl
+        # select the tfidf dims here, encode_ann would otherwise cache them on the workers' copies of the model
+        # and the serialised model would go without them
+        for lbl in list(self._lbl_data):
+            self.get_top_tfidf_dimension_index(lbl)
+        # docs are read in parallel and merged in file order
+        for r in self.read_docs(LabelModel.read_labelled_doc, (ann_dir, gold_dir), doc_keys, n_jobs=n_jobs,
+                                doc_kwargs=[{'annotated': annotated_anns['%s.txt' % fk.replace('se_ann_', '')]
+                                             if len(annotated_anns) > 0 else None} for fk in doc_keys],
+                                verbose=verbose, ignore_mappings=ignore_mappings, ignore_context=ignore_context,
+                                separate_by_label=separate_by_label, ful_text_dir=ful_text_dir, eHostGD=eHostGD):
+            if r is None:
+                continue
+            for lbl in r['lbl2data']:
+                if lbl not in lbl2data:
+                    lbl2data[lbl] = {'X': [], 'Y': [], 'multiple_tps': 0, 'doc_anns': []}
+                    lbl2blocks[lbl] = []
+                for k in ['Y', 'doc_anns']:
+                    lbl2data[lbl][k] += r['lbl2data'][lbl][k]
+                lbl2blocks[lbl].append(r['lbl2data'][lbl]['X'])
+                lbl2data[lbl]['multiple_tps'] += r['lbl2data'][lbl]['multiple_tps']
+            for ql in r['query_label_perform']:
                 if ql not in query_label_perform:
                     query_label_perform[ql] = {'c': 0, 'w': 0}
-                if matched:
-                    query_label_perform[ql]['c'] += 1
-                else:
-                    query_label_perform[ql]['w'] += 1
-            false_negatives += len(not_matched_gds)
-
-            missed = None
-            for g in gd.get_ess_entities():
-                if g.id in not_matched_gds:
-                    missed = g
-                    logging.debug('\t'.join(
-                        ['M', g.str, str(g.negated), str(g.start), str(g.end), join(gold_dir, '%s-ann.xml' % fk)]))
-            # if len(not_matched_gds) > 0:
-            #     print not_matched_gds
-            #     for a in anns:
-            #         logging.debug(a.str, a.start, a.end, missed.overlap(a))
+                query_label_perform[ql]['c'] += r['query_label_perform'][ql]['c']
+                query_label_perform[ql]['w'] += r['query_label_perform'][ql]['w']
+            false_negatives += r['fns']
+        # one allocation per label for the whole feature matrix
+        for lbl in lbl2data:
+            lbl2data[lbl]['X'] = numpy.concatenate(lbl2blocks[lbl])
         bad_labels = []
         for ql in query_label_perform:
             p = query_label_perform[ql]
@@ -467,6 +467,134 @@ class LabelModel(object):
         return {'lbl2data': lbl2data,
                 'fns': false_negatives, 'bad_labels': bad_labels, 'files': file_keys}
 
+    def read_docs(self, read_doc, args, file_keys, n_jobs=-1, doc_kwargs=None, **kwargs):
+        """
+        read_doc(self, *args, fk, **kwargs) of every doc in parallel, results in file order; the docs go to the
+        workers in a few contiguous chunks so that the model is pickled once per chunk instead of once per doc
+        :param doc_kwargs: extra kwargs of each doc, in file_keys order
+        """
+        docs = list(zip(file_keys, [{}] * len(file_keys) if doc_kwargs is None else doc_kwargs))
+        chunk_size = max(1, -(-len(docs) // (jl.effective_n_jobs(n_jobs) * 4)))
+        chunks = jl.Parallel(n_jobs=n_jobs)(
+            jl.delayed(LabelModel.read_doc_chunk)(self, read_doc, args, docs[i:i + chunk_size], kwargs,
+                                                  logging.getLogger().getEffectiveLevel())
+            for i in range(0, len(docs), chunk_size))
+        return [r for chunk in chunks for r in chunk]
+
+    @staticmethod
+    def read_doc_chunk(label_model, read_doc, args, docs, kwargs, log_level):
+        """
+        read a chunk of (file key, doc kwargs) pairs for read_docs, in a worker process
+        :param log_level: the caller's log level, worker processes do not inherit its logging setup
+        """
+        utils.init_worker_logging(log_level)
+        return [read_doc(label_model, *args, fk, **dict(kwargs, **doc_kw)) for fk, doc_kw in docs]
+
+    @staticmethod
+    def read_labelled_doc(label_model, ann_dir, gold_dir, fk, verbose=True, ignore_mappings=[], ignore_context=False,
+                          separate_by_label=False, ful_text_dir=None, eHostGD=False, annotated=None):
+        """
+        encode the anns of one doc and label them against its gold standard for load_data
+        :param annotated: anns assessed by the annotators on this doc, None to keep all anns
+        :return: None if the gold standard doc does not exist, otherwise the doc's lbl2data,
+        per query label correct/wrong counts and false negatives
+        """
+        cr = CustomisedRecoginiser(join(ann_dir, '%s.json' % fk), label_model.concept_mapping)
+        fk = fk.replace('se_ann_', '')
+        if ful_text_dir is not None:
+            cr.full_text_folder = ful_text_dir
+        if eHostGD:
+            if not isfile(join(gold_dir, '%s.txt.knowtator.xml' % fk)):
+                return None
+            # logging.debug('using GD file %s' % join(gold_dir, '%s.txt.knowtator.xml' % fk))
+            gd = eHostGenedDoc(join(gold_dir, '%s.txt.knowtator.xml' % fk))
+        else:
+            if not isfile(join(gold_dir, '%s-ann.xml' % fk)):
+                return None
+            logging.debug('using GD file %s' % join(gold_dir, '%s-ann.xml' % fk))
+            gd = EDIRDoc(join(gold_dir, '%s-ann.xml' % fk))
+
+        # re-segement sentences
+        # cr.re_segment_sentences(fk)
+        # cr.relocate_all_anns(fk)
+        # gd.relocate_anns(cr.get_full_text(fk))
+
+        label = label_model.label
+        label_type = label.replace('neg_', '')
+        lbl2data = {}
+        query_label_perform = {}
+        not_matched_gds = []
+        for e in gd.get_ess_entities():
+            if (ignore_context and e.label.replace('neg_', '') == label_type) \
+                    or (not ignore_context and e.label == label):
+                not_matched_gds.append(e.id)
+
+        anns = cr.get_anns_by_label(label, ignore_mappings=ignore_mappings, no_context=ignore_context)
+        if annotated is not None:
+            kept_anns = []
+            for a in anns:
+                for aa in annotated:
+                    if int(aa['s']) == a.start and int(aa['e']) == a.end:
+                        kept_anns.append(a)
+            anns = kept_anns
+        for a in anns:
+            logging.debug('%s, %s, %s' % (a.str, a.start, a.end))
+            multiple_true_positives = 0
+            t2anns = cr.get_prior_anns(a)
+            # if len(t2anns['umls']) + len(t2anns['phenotype']) == 0:
+            #     t2anns = cr.get_prior_anns(a, contenxt_depth=-2)
+            context_anns = [] + t2anns['umls'] + t2anns['phenotype'] + \
+                           cr.get_context_words(a, fk)
+            # context_anns = cr.get_context_words(a, fk)
+            matched = False
+            for g in gd.get_ess_entities():
+                if g.id in not_matched_gds:
+                    gt = g.label.replace('neg_', '')
+                    if g.overlap(a) and ((g.label == label and not ignore_context) or
+                                         (ignore_context and gt == label_type)):
+                        if matched:
+                            multiple_true_positives += 1
+                        matched = True
+                        not_matched_gds.remove(g.id)
+            if verbose and logging.getLogger().isEnabledFor(logging.DEBUG):
+                if not matched:
+                    logging.debug('%s %s %s' % ('!',
+                                                LabelModel.get_ann_dim_label(a) +
+                                                ' // ' + ' | '.join(LabelModel.get_ann_dim_label(a, generalise=True)
+                                                                    for a in context_anns), fk))
+                else:
+                    logging.debug('%s %s %s' % ('R',
+                                                LabelModel.get_ann_dim_label(a) + ' // ' + ' | '.join(
+                                                    LabelModel.get_ann_dim_label(a, generalise=True)
+                                                    for a in context_anns), fk))
+
+            lbl = LabelModel.get_label_specific_data(label_model, lbl2data, a, context_anns, fk, cr,
+                                                     separate_by_label=separate_by_label)
+
+            lbl2data[lbl]['multiple_tps'] += multiple_true_positives
+            Y = lbl2data[lbl]['Y']
+            Y.append([1 if matched else 0])
+            ql = lbl
+            if ql not in query_label_perform:
+                query_label_perform[ql] = {'c': 0, 'w': 0}
+            if matched:
+                query_label_perform[ql]['c'] += 1
+            else:
+                query_label_perform[ql]['w'] += 1
+
+        for g in gd.get_ess_entities():
+            if g.id in not_matched_gds:
+                logging.debug('\t'.join(
+                    ['M', g.str, str(g.negated), str(g.start), str(g.end), join(gold_dir, '%s-ann.xml' % fk)]))
+        # if len(not_matched_gds) > 0:
+        #     print not_matched_gds
+        #     for a in anns:
+        #         logging.debug(a.str, a.start, a.end, missed.overlap(a))
+        # hand back a single int8 block per label rather than one array per ann
+        for lbl in lbl2data:
+            lbl2data[lbl]['X'] = numpy.vstack(lbl2data[lbl]['X'])
+        return {'lbl2data': lbl2data, 'query_label_perform': query_label_perform, 'fns': len(not_matched_gds)}
+
     @staticmethod
     def get_label_specific_data(label_model, lbl2data, annotation, context_anns, fk, cr,
                                 separate_by_label=False):
@@ -514,18 +642,22 @@ class LabelModel(object):
         cm = self.concept_mapping
         file_keys = [f[:f.rfind('.')] for f in listdir(ann_dir) if isfile(join(ann_dir, f))]
         lbl2data = {}
-        for fk in file_keys:
-            cr = CustomisedRecoginiser(join(ann_dir, '%s.json' % fk), cm)
+        # the next docs are read while the current one is processed
+        for fk, raw in zip(file_keys, utils.prefetch_files([join(ann_dir, '%s.json' % fk) for fk in file_keys])):
+            cr = CustomisedRecoginiser(join(ann_dir, '%s.json' % fk), cm, ann_doc=utils.load_json_bytes(raw))
             fk = fk.replace('se_ann_', '')
             if full_text_dir is not None:
                 cr.full_text_folder = full_text_dir
             LabelModel.read_one_ann_doc(self, cr, fk, lbl2data=lbl2data,
                                         ignore_mappings=ignore_mappings, ignore_context=ignore_context,
                                         separate_by_label=separate_by_label)
+        # int8 matrices go straight to the models, sklearn casts them once as needed
+        for lbl in lbl2data:
+            lbl2data[lbl]['X'] = numpy.vstack(lbl2data[lbl]['X'])
         return {'lbl2data': lbl2data, 'files': file_keys}
 
     def serialise(self, output_file):
-        jl.dump(self, output_file)
+        jl.dump(self, output_file, **_DUMP_KW)
 
     @staticmethod
     def type_related_ann_filter(ann, cm_obj):
@@ -552,31 +684,26 @@ class LabelModel(object):
 
     @staticmethod
     def deserialise(serialised_file):
-        return jl.load(serialised_file)
+        # the same model file is loaded repeatedly in experiments, so its bytes are cached until it is rewritten;
+        # callers change the model (e.g. max_dimensions), each call gets its own copy
+        st = stat(serialised_file)
+        return jl.load(BytesIO(LabelModel._read_serialised(serialised_file, st.st_mtime_ns, st.st_size)))
+
+    @staticmethod
+    @lru_cache(maxsize=32)
+    def _read_serialised(serialised_file, mtime_ns, size):
+        return utils.read_binary_file(serialised_file)
 
     @staticmethod
     def get_ann_dim_label(ann, generalise=False, no_negation=False):
         if isinstance(ann, str):
             return 'WORD_%s' % ann
-        negated = ''
-        label = ann.str
-        if (hasattr(ann, 'negation') and ann.negation == 'Negated') or (hasattr(ann, 'negated') and ann.negated):
-            negated = 'neg_'
-        if no_negation:
-            negated = ''
+        # the negation prefix ('neg_' for Negated anns) is currently left out of every dimension label,
+        # so no_negation has no effect and the label is just the lower cased ann text
         # if hasattr(ann, 'cui'):
         #     label = ann.cui + ' ' + str(ann.pref)
-        # ann.str
-        if hasattr(ann, 'minor_type'):
-            label = ann.str
         # if generalise and hasattr(ann, 'sty'):
         #     label = ann.sty
         # if ann.sty.lower() == 'body part, organ, or organ component':
-        negated = ''
-        return negated + label.lower()
+        return ann.str.lower()
         # return ann.str.lower() if not isinstance(ann, SemEHRAnn) else ann.cui.lower()
-
-
-
-
-
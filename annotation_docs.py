@@ -3,14 +3,22 @@ from os import listdir
 from os.path import basename, isfile, join
 import logging
 import re
+from collections import defaultdict
+from bisect import bisect_left, bisect_right
+import numpy
 from learners import LabelPerformance
 # import reportreader as rr
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 
 class BasicAnn(object):
     """
     a simple NLP (Named Entity) annotation class
     """
+    __slots__ = ('_str', '_start', '_end', '_id')
 
     def __init__(self, str, start, end):
         self._str = str
@@ -75,6 +83,7 @@ class EDIRAnn(BasicAnn):
     """
     EDIR annotation class
     """
+    __slots__ = ('_type', '_negated')
 
     def __init__(self, str, start, end, type):
         self._type = type
@@ -109,6 +118,7 @@ class ContextedAnn(BasicAnn):
     """
     a contextulised annotation class (negation/tempolarity/experiencer)
     """
+    __slots__ = ('_neg', '_temp', '_exp')
 
     def __init__(self, str, start, end, negation, temporality, experiencer):
         self._neg = negation
@@ -145,6 +155,7 @@ class PhenotypeAnn(ContextedAnn):
     """
     a simple customisable phenotype annotation (two attributes for customised attributes)
     """
+    __slots__ = ('_major_type', '_minor_type')
 
     def __init__(self, str, start, end,
                  negation, temporality, experiencer,
@@ -199,6 +210,7 @@ class SemEHRAnn(ContextedAnn):
     """
     SemEHR Annotation Class
     """
+    __slots__ = ('_cui', '_sty', '_pref', '_ann_type', '_ruled_by', '_study_concepts')
 
     def __init__(self, str, start, end,
                  negation, temporality, experiencer,
@@ -272,6 +284,10 @@ class SemEHRAnnDoc(object):
         self._phenotype_anns = []
         self._sentences = []
         self._others = []
+        self._sent_index = None
+        self._ann_spans = None
+        self._soa = None
+        self._span2anns = {}
         self.load_anns()
 
     def load_anns(self):
@@ -320,12 +336,122 @@ class SemEHRAnnDoc(object):
                                      int(ann['startNode']['offset']),
                                      int(ann['endNode']['offset']))
                         self._sentences.append(a)
-                        self._sentences = sorted(self._sentences, key=lambda x: x.start)
                         a.id = 'sent-%s' % len(self._sentences)
                     else:
                         self._others.append(ann)
+        self.sort_anns()
+
+    def sort_anns(self):
+        """
+        keep annotations, phenotypes and sentences ordered by start offset
+        """
+        self._anns.sort(key=lambda x: x.start)
+        self._phenotype_anns.sort(key=lambda x: x.start)
+        self._sentences.sort(key=lambda x: x.start)
+        self.reset_indices()
+
+    def reset_indices(self):
+        """
+        drop the position indices, needed whenever annotation or sentence offsets change
+        """
+        self._sent_index = None
+        self._ann_spans = None
+        self._soa = None
+        self._span2anns = {}
+
+    def get_sentence_index(self):
+        """
+        sentence starts and running maximum of sentence ends (sentences are kept sorted by start)
+        """
+        if self._sent_index is None:
+            max_ends = []
+            for s in self._sentences:
+                max_ends.append(s.end if len(max_ends) == 0 else max(max_ends[-1], s.end))
+            self._sent_index = ([s.start for s in self._sentences], max_ends)
+        return self._sent_index
+
+    def get_span_anns(self, start, end):
+        """
+        umls and phenotype annotations overlapping with the span, both ordered by start
+        """
+        if (start, end) not in self._span2anns:
+            if self._ann_spans is None:
+                self._ann_spans = (SemEHRAnnDoc.get_span_arrays(self._anns),
+                                   SemEHRAnnDoc.get_span_arrays(self._phenotype_anns))
+            self._span2anns[(start, end)] = (
+                SemEHRAnnDoc.get_sorted_overlapped(self._anns, self._ann_spans[0], start, end),
+                SemEHRAnnDoc.get_sorted_overlapped(self._phenotype_anns, self._ann_spans[1], start, end))
+        return self._span2anns[(start, end)]
 
-            sorted(all_anns, key=lambda x: x.start)
+    @staticmethod
+    def get_sorted_overlapped(anns, span_arrays, start, end):
+        """
+        anns (sorted by start) overlapping with the span, only those starting before its end are checked
+        """
+        starts, ends = span_arrays
+        hi = numpy.searchsorted(starts, end, side='right')
+        return [anns[i] for i in numpy.nonzero(ends[:hi] >= start)[0]]
+
+    def to_soa(self, cui2id=None):
+        """
+        the umls annotations as parallel arrays (in annotation order)
+        :param cui2id: cui to id, unseen cuis are added to it; pass the same dict to share the ids across docs
+        :return: dict of start, end (int32), negated, ruled (uint8) and cui (int32 id) arrays
+        """
+        cui2id = {} if cui2id is None else cui2id
+        starts, ends = SemEHRAnnDoc.get_span_arrays(self._anns)
+        return {'start': starts, 'end': ends,
+                'negated': numpy.array([a.negation == 'Negated' for a in self._anns], dtype=numpy.uint8),
+                'ruled': numpy.array([len(a.ruled_by) > 0 for a in self._anns], dtype=numpy.uint8),
+                'cui': numpy.array([cui2id.setdefault(a.cui, len(cui2id)) for a in self._anns], dtype=numpy.int32)}
+
+    def get_soa(self):
+        """
+        to_soa of this doc and its cui ids, kept until the indices are reset
+        :return: (soa, cui2id)
+        """
+        if self._soa is None:
+            cui2id = {}
+            self._soa = (self.to_soa(cui2id), cui2id)
+        return self._soa
+
+    @staticmethod
+    def get_span_arrays(anns):
+        """
+        start and end offsets of the anns as two int32 arrays
+        """
+        return numpy.array([a.start for a in anns], dtype=numpy.int32), \
+            numpy.array([a.end for a in anns], dtype=numpy.int32)
+
+    @staticmethod
+    def get_span_index(anns):
+        """
+        span arrays of the anns ordered by start, with the longest span length
+        """
+        starts, ends = SemEHRAnnDoc.get_span_arrays(anns)
+        order = numpy.argsort(starts, kind='stable')
+        return starts[order], ends[order], max(int((ends - starts).max()), 0) if len(anns) > 0 else 0
+
+    @staticmethod
+    def get_any_overlapped(anns, span_index):
+        """
+        boolean array, True for each of the anns overlapping with any span of the index
+        """
+        starts, ends, max_len = span_index
+        ann_starts, ann_ends = SemEHRAnnDoc.get_span_arrays(anns)
+        # only spans starting within [ann start - longest span, ann end] can overlap
+        los = numpy.searchsorted(starts, ann_starts - max_len, side='left')
+        his = numpy.searchsorted(starts, ann_ends, side='right')
+        return numpy.array([(ends[lo:hi] >= s).any() for lo, hi, s in zip(los, his, ann_starts)], dtype=bool)
+
+    @staticmethod
+    def get_overlap_matrix(anns, other_anns):
+        """
+        boolean matrix, [i, j] is True when anns[i] overlaps with other_anns[j]
+        """
+        starts, ends = SemEHRAnnDoc.get_span_arrays(anns)
+        other_starts, other_ends = SemEHRAnnDoc.get_span_arrays(other_anns)
+        return (starts[:, None] <= other_ends[None, :]) & (ends[:, None] >= other_starts[None, :])
 
     @property
     def annotations(self):
@@ -337,7 +463,8 @@ class SemEHRAnnDoc(object):
 
     @sentences.setter
     def sentences(self, value):
-        self._sentences = value
+        self._sentences = sorted(value, key=lambda x: x.start)
+        self.reset_indices()
 
     @property
     def phenotypes(self):
@@ -386,11 +513,20 @@ class Concept2Mapping(object):
         self._concept_map_file = concept_map_file
         self._cui2label = {}
         self._concept2label = None
+        self._label2cuis = defaultdict(set)
         self._type2concept = {}
         self._type2gaz = {}
         self._all_entities = []
         self.load_concept_mappings()
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # mappings pickled (within label models) before the label index existed only carry concept2label
+        self._label2cuis = defaultdict(set)
+        for c in self._concept2label or {}:
+            for t in self._concept2label[c]:
+                self._label2cuis[t].add(c)
+
     def load_concept_mappings(self):
         concept_mapping = utils.load_json_data(self._concept_map_file)
         concept2types = {}
@@ -405,7 +541,7 @@ class Concept2Mapping(object):
                     concept2types[c] = []
                 concept2types[c].append(t)
                 self._all_entities.append(c.lower())
-        self._concept2label = concept2types
+        self.concept2label = concept2types
 
     def load_gaz_dir(self, gaz_dir):
         files = [f for f in listdir(gaz_dir) if isfile(join(gaz_dir, f))]
@@ -426,6 +562,14 @@ class Concept2Mapping(object):
     @concept2label.setter
     def concept2label(self, value):
         self._concept2label = value
+        self._label2cuis = defaultdict(set)
+        for c in value:
+            for t in value[c]:
+                self._label2cuis[t].add(c)
+
+    @property
+    def label2cuis(self):
+        return self._label2cuis
 
     def type2cocnepts(self, type):
         return self._type2concept[type]
@@ -502,12 +646,13 @@ class CustomisedRecoginiser(SemEHRAnnDoc):
 
     def get_ann_sentence(self, ann):
         sent = None
-        for s in self.sentences:
-            if ann.overlap(s):
-                sent = s
-                break
+        # the first sentence overlapping the ann is the first whose running max end reaches ann.start
+        starts, max_ends = self.get_sentence_index()
+        idx = bisect_left(max_ends, ann.start)
+        if idx < bisect_right(starts, ann.end):
+            sent = self.sentences[idx]
         if sent is None:
-            print('sentence not found for %s' % ann.__dict__)
+            print('sentence not found for %s' % ann.serialise_json())
             return None
         return sent
 
@@ -515,28 +660,24 @@ class CustomisedRecoginiser(SemEHRAnnDoc):
         sent = self.get_ann_sentence(ann)
         if sent is None:
             return None
-        sents = []
-        for s in self.sentences:
-            if s.start < sent.start:
-                sents.append(s)
-        return sorted(sents + ([] if not include_self else [sent]), key=lambda s: s.start)
+        starts, max_ends = self.get_sentence_index()
+        return self.sentences[:bisect_left(starts, sent.start)] + ([] if not include_self else [sent])
 
     def get_sent_anns(self, sent, ann_ignore=None, filter_fun=None, filter_param=None):
         ret = {'umls': [], 'phenotype': []}
-        for a in self.annotations:
-            if a.overlap(sent):
-                if ann_ignore is not None and ann_ignore.overlap(a):
-                    continue
-                if filter_fun is not None and filter_fun(a, filter_param):
-                    continue
-                ret['umls'].append(a)
-        for a in self.phenotypes:
-            if a.overlap(sent):
-                if ann_ignore is not None and ann_ignore.overlap(a):
-                    continue
-                if filter_fun is not None and filter_fun(a, filter_param):
-                    continue
-                ret['phenotype'].append(a)
+        umls_anns, phenotype_anns = self.get_span_anns(sent.start, sent.end)
+        for a in umls_anns:
+            if ann_ignore is not None and ann_ignore.overlap(a):
+                continue
+            if filter_fun is not None and filter_fun(a, filter_param):
+                continue
+            ret['umls'].append(a)
+        for a in phenotype_anns:
+            if ann_ignore is not None and ann_ignore.overlap(a):
+                continue
+            if filter_fun is not None and filter_fun(a, filter_param):
+                continue
+            ret['phenotype'].append(a)
         return ret
 
     def get_same_sentence_anns(self, ann):
@@ -582,6 +723,7 @@ class CustomisedRecoginiser(SemEHRAnnDoc):
             s, e = relocate_annotation_pos(t, a.start, a.end, a.str)
             a.start = s
             a.end = e
+        self.sort_anns()
 
     def re_segment_sentences(self, fk):
         text = self.get_full_text(fk)
@@ -631,33 +773,31 @@ class CustomisedRecoginiser(SemEHRAnnDoc):
         return words
 
     def get_anns_by_label(self, label, ignore_mappings=[], no_context=False):
-        anns = []
         t = label.replace('neg_', '')
-        for a in self.annotations:
-            if a.cui not in self.concept2label:
-                continue
-            if a.cui in ignore_mappings:
-                continue
-            if len(a.ruled_by) > 0:
-                continue
-            if t in self.concept2label[a.cui]:
-                if no_context:
-                    anns.append(a)
-                elif label.startswith('neg_') and a.negation == 'Negated':
-                    anns.append(a)
-                elif not label.startswith('neg_') and a.negation != 'Negated':
-                    anns.append(a)
+        ignored = set(ignore_mappings)
+        label_cuis = self._concept_mapping.label2cuis.get(t, ())
+        # the umls anns are selected on the doc's array columns rather than ann by ann
+        soa, cui2id = self.get_soa()
+        selected = numpy.isin(soa['cui'], [cui2id[c] for c in label_cuis if c in cui2id and c not in ignored]) & \
+            (soa['ruled'] == 0)
+        if not no_context:
+            selected &= soa['negated'] == (1 if label.startswith('neg_') else 0)
+        selected = numpy.nonzero(selected)[0]
+        anns = [self._anns[i] for i in selected]
+        ann_starts, ann_ends = soa['start'][selected], soa['end'][selected]
         # anns = []
         phenotypes = []
         smaller_to_remove = []
+        ignored_strs = set(s.lower() for s in ignored)
         for a in self.phenotypes:
             if a.minor_type == t:
-                if a.str.lower() in [s.lower() for s in ignore_mappings]:
+                if a.str.lower() in ignored_strs:
                     continue
                 if no_context or (label.startswith('neg_') and a.negation == 'Negated') or \
                         (not label.startswith('neg_') and a.negation != 'Negated'):
                     overlaped = False
-                    for ann in anns + phenotypes:
+                    candidates = [anns[i] for i in numpy.nonzero((ann_starts <= a.end) & (ann_ends >= a.start))[0]]
+                    for ann in candidates + phenotypes:
                         if ann.overlap(a):
                             if a.is_larger(ann):
                                 smaller_to_remove.append(ann)
@@ -666,25 +806,19 @@ class CustomisedRecoginiser(SemEHRAnnDoc):
                                 break
                     if not overlaped:
                         phenotypes.append(a)
-        for o in smaller_to_remove:
-            if o in anns:
-                anns.remove(o)
-            if o in phenotypes:
-                phenotypes.remove(o)
-        return anns + phenotypes
+        to_remove = set(id(o) for o in smaller_to_remove)
+        return [a for a in anns if id(a) not in to_remove] + [p for p in phenotypes if id(p) not in to_remove]
 
     def get_combined_anns(self):
         if self._combined is not None:
             return self._combined
-        anns = [] + self.get_mapped_labels()
-        for ann in self.get_customised_phenotypes():
-            overlaped = False
-            for m in self.get_mapped_labels():
-                if ann.overlap(m):
-                    overlaped = True
-                    break
-            if not overlaped:
-                anns.append(ann)
+        mapped = self.get_mapped_labels()
+        phenotypes = self.get_customised_phenotypes()
+        overlapped = SemEHRAnnDoc.get_any_overlapped(phenotypes, SemEHRAnnDoc.get_span_index(mapped))
+        anns = [] + mapped
+        for idx in range(len(phenotypes)):
+            if not overlapped[idx]:
+                anns.append(phenotypes[idx])
         self._combined = anns
         return anns
 
@@ -698,20 +832,31 @@ class CustomisedRecoginiser(SemEHRAnnDoc):
 
     @staticmethod
     def validate(gold_anns, learnt_anns, label2performance):
-        matched_ann_ids = []
-        for ga in gold_anns:
-            l = ga.label
+        # a gold ann is matched by the first learnt ann with the same label overlapping it
+        label2code = {}
+        gold_labels = numpy.array([label2code.setdefault(a.label, len(label2code)) for a in gold_anns],
+                                  dtype=numpy.int32)
+        learnt_labels = numpy.array([label2code.setdefault(a.label, len(label2code)) for a in learnt_anns],
+                                    dtype=numpy.int32)
+        if len(learnt_anns) == 0:
+            first_matches = numpy.full(len(gold_anns), -1)
+        elif _first_matches_jit is not None:
+            first_matches = _first_matches_jit(*(SemEHRAnnDoc.get_span_arrays(gold_anns) + (gold_labels,) +
+                                                 SemEHRAnnDoc.get_span_arrays(learnt_anns) + (learnt_labels,)))
+        else:
+            matches = SemEHRAnnDoc.get_overlap_matrix(gold_anns, learnt_anns) & \
+                (gold_labels[:, None] == learnt_labels[None, :])
+            first_matches = numpy.where(matches.any(axis=1), matches.argmax(axis=1), -1)
+        matched_ann_ids = set()
+        for idx in range(len(gold_anns)):
+            l = gold_anns[idx].label
             if l not in label2performance:
                 label2performance[l] = LabelPerformance(l)
             performance = label2performance[l]
-            matched = False
-            for la in learnt_anns:
-                if la.label == l and la.overlap(ga):
-                    matched = True
-                    performance.increase_true_positive()
-                    matched_ann_ids.append(la.id)
-                    break
-            if not matched:
+            if first_matches[idx] >= 0:
+                performance.increase_true_positive()
+                matched_ann_ids.add(learnt_anns[first_matches[idx]].id)
+            else:
                 performance.increase_false_negative()
         for la in learnt_anns:
             if la.id not in matched_ann_ids:
@@ -735,6 +880,24 @@ class CustomisedRecoginiser(SemEHRAnnDoc):
         return s
 
 
+def _first_matches(gold_starts, gold_ends, gold_labels, learnt_starts, learnt_ends, learnt_labels):
+    """
+    index of the first learnt ann with the same label overlapping each gold ann, -1 if there is none
+    """
+    first_matches = numpy.full(len(gold_starts), -1, dtype=numpy.int64)
+    for i in range(len(gold_starts)):
+        for j in range(len(learnt_starts)):
+            if learnt_labels[j] == gold_labels[i] and \
+                    gold_starts[i] <= learnt_ends[j] and gold_ends[i] >= learnt_starts[j]:
+                first_matches[i] = j
+                break
+    return first_matches
+
+
+# validate falls back to a (gold x learnt) numpy overlap matrix when numba is not installed
+_first_matches_jit = njit(_first_matches) if njit is not None else None
+
+
 def relocate_annotation_pos(t, s, e, string_orig):
     if t[s:e] == string_orig:
         return [s, e]
@@ -1,18 +1,43 @@
 import joblib as jl
+try:
+    # optional Intel extension, patches the sklearn estimators imported below when installed
+    from sklearnex import patch_sklearn
+    patch_sklearn()
+except ImportError:
+    pass
 from sklearn import tree
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.gaussian_process import GaussianProcessClassifier
 from sklearn.naive_bayes import GaussianNB
+from sklearn.dummy import DummyClassifier
 from sklearn import svm
 from sklearn.decomposition import PCA
 from sklearn.cluster import DBSCAN
 from sklearn.neighbors import KNeighborsClassifier, KDTree
 from sklearn.metrics.pairwise import cosine_similarity
 import logging
-from os.path import basename, isfile, join, split
-from os import listdir, remove
-import graphviz
+import pickle
+from os.path import basename, isfile, join, split, getmtime
+from os import listdir, remove, stat
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 import numpy
+try:
+    from skl2onnx import convert_sklearn
+    from skl2onnx.common.data_types import FloatTensorType
+except ImportError:
+    convert_sklearn = None
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+# tree visualisations are rendered (dot subprocess) in the background while learning goes on,
+# pending renders are waited for at interpreter exit
+_render_executor = ThreadPoolExecutor(max_workers=2)
+
+# uncompressed files with the fastest pickle protocol of the running python; loaded arrays are memory mapped
+_DUMP_KW = dict(compress=0, protocol=pickle.HIGHEST_PROTOCOL)
+_LOAD_KW = dict(mmap_mode='r')
 
 
 class PhenomeLearners(object):
@@ -24,12 +49,21 @@ class PhenomeLearners(object):
         return self._setting['min_sample_size']
 
     @staticmethod
-    def decision_tree_learning(self, X, Y, lm, output_file=None, pca_dim=None, pca_file=None, tree_viz_file=None,
+    def decision_tree_learning(X, Y, lm, output_file=None, pca_dim=None, pca_file=None, tree_viz_file=None,
                                lbl='united', min_sample_size=25):
         if len(X) <= min_sample_size:
             logging.warning('not enough data found for prediction: %s' % lm.label)
-            if isfile(output_file):
-                remove(output_file)
+            if output_file is not None:
+                PhenomeLearners.remove_if_exists(output_file)
+            return
+        labels = numpy.asarray(Y).ravel()
+        if (labels == labels[0]).all():
+            # no tree to learn, but the model file must keep predicting the one class seen:
+            # without it predict_use_model falls back to predicting every instance true
+            logging.warning('all same labels, constant prediction saved for %s' % lm.label)
+            if output_file is not None:
+                jl.dump(DummyClassifier(strategy='constant', constant=labels[0]).fit(X, labels), output_file,
+                        **_DUMP_KW)
             return
         pca = None
         if pca_dim is not None:
@@ -37,14 +71,18 @@ class PhenomeLearners(object):
             X_new = pca.fit_transform(X)
         else:
             X_new = X
-        clf = tree.DecisionTreeClassifier()
-        clf = clf.fit(X_new, Y)
+        # trees split on float32, handing it over contiguous saves sklearn a converted copy
+        X_new = numpy.ascontiguousarray(X_new, dtype=numpy.float32)
+        clf = tree.DecisionTreeClassifier(random_state=0)
+        clf = clf.fit(X_new, numpy.asarray(Y).ravel())
         if output_file is not None:
-            jl.dump(clf, output_file)
+            jl.dump(clf, output_file, **_DUMP_KW)
             logging.info('model file saved to %s' % output_file)
         if pca is not None and pca_file is not None:
-            jl.dump(pca, pca_file)
+            jl.dump(pca, pca_file, **_DUMP_KW)
         if tree_viz_file is not None:
+            # only needed for the visualisation, not imported with the module
+            import graphviz
             label_feature_names = []
             if lm.use_one_dimension_for_label:
                 label_feature_names.append('label')
@@ -63,53 +101,122 @@ class PhenomeLearners(object):
                                             class_names=['Yes', 'No'],
                                             special_characters=True)
             graph = graphviz.Source(dot_data)
+            _render_executor.submit(PhenomeLearners.render_tree_viz, graph, tree_viz_file)
+
+    @staticmethod
+    def remove_if_exists(file_path):
+        """
+        remove a stale model file, a missing one is fine
+        """
+        try:
+            remove(file_path)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def render_tree_viz(graph, tree_viz_file):
+        try:
             graph.render(tree_viz_file)
+        except Exception as e:
+            logging.error('failed to render %s: %s' % (tree_viz_file, e))
 
     @staticmethod
-    def random_forest_learning(X, Y, output_file=None):
+    def random_forest_learning(X, Y, output_file=None, n_jobs=-1):
         if len(X) == 0:
             logging.warning('no data found for prediction')
             return
-        clf = RandomForestClassifier()
-        clf = clf.fit(X, Y)
+        clf = RandomForestClassifier(n_estimators=128, n_jobs=n_jobs, random_state=0)
+        # hand sklearn the float32 matrix and flat label vector it works on, sparing its validation the copies
+        clf = clf.fit(numpy.ascontiguousarray(X, dtype=numpy.float32), numpy.asarray(Y, dtype=numpy.int8).ravel())
         if output_file is not None:
-            jl.dump(clf, output_file)
+            jl.dump(clf, output_file, **_DUMP_KW)
             logging.info('model file saved to %s' % output_file)
+            PhenomeLearners.export_onnx(clf, len(X[0]), output_file)
+
+    @staticmethod
+    def export_onnx(clf, n_features, model_file):
+        """
+        save an onnx copy of the model next to the model file (model_file + '.onnx'), needs skl2onnx;
+        without a fresh copy model_predict falls back to the joblib model
+        """
+        onnx_file = model_file + '.onnx'
+        # a copy left from an earlier model must not be picked up for this one
+        PhenomeLearners.remove_if_exists(onnx_file)
+        if convert_sklearn is None:
+            return
+        try:
+            onx = convert_sklearn(clf, initial_types=[('input', FloatTensorType([None, n_features]))],
+                                  options={id(clf): {'zipmap': False}})
+            with open(onnx_file, 'wb') as f:
+                f.write(onx.SerializeToString())
+        except Exception as e:
+            # e.g. skl2onnx has no converter for the sklearnex patched estimators
+            logging.warning('onnx export of %s failed, predicting with the joblib model: %s' % (model_file, e))
+            PhenomeLearners.remove_if_exists(onnx_file)
+            return
+        logging.info('onnx model saved to %s' % onnx_file)
+
+    @staticmethod
+    def model_predict(model_file, X):
+        """
+        predict with the onnx copy of the model when onnxruntime is installed and the copy is up to date,
+        otherwise with the joblib model
+        """
+        onnx_file = model_file + '.onnx'
+        if onnxruntime is not None and isfile(onnx_file) and getmtime(onnx_file) >= getmtime(model_file):
+            st = stat(onnx_file)
+            session = PhenomeLearners._load_onnx_session(onnx_file, st.st_mtime_ns, st.st_size)
+            return session.run(None, {'input': numpy.asarray(X, dtype=numpy.float32)})[0]
+        return PhenomeLearners.load_model(model_file).predict(X)
+
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def _load_onnx_session(onnx_file, mtime_ns, size):
+        # bounded like _load_model, sessions of rewritten onnx files age out instead of piling up
+        return onnxruntime.InferenceSession(onnx_file, providers=['CPUExecutionProvider'])
+
+    @staticmethod
+    def load_model(model_file):
+        """
+        jl.load the model (or pca) file, cached until the file is rewritten
+        """
+        st = stat(model_file)
+        return PhenomeLearners._load_model(model_file, st.st_mtime_ns, st.st_size)
+
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def _load_model(model_file, mtime_ns, size):
+        return jl.load(model_file, **_LOAD_KW)
 
     @staticmethod
     def svm_learning(X, Y, output_file=None):
         if len(X) == 0:
             logging.info('no data found for prediction')
             return
-        v = -1
-        all_same = True
-        for y in Y:
-            if v == -1:
-                v = y[0]
-            if v != y[0]:
-                all_same = False
-                break
-        if all_same:
+        labels = numpy.asarray(Y)
+        labels = labels[:, 0] if labels.ndim > 1 else labels
+        if len(labels) == 0 or (labels == labels[0]).all():
             logging.warning('all same labels %s' % Y)
             return
         clf = svm.SVC(kernel='sigmoid')
         clf = clf.fit(X, Y)
         if output_file is not None:
-            jl.dump(clf, output_file)
+            jl.dump(clf, output_file, **_DUMP_KW)
             logging.info('model file saved to %s' % output_file)
 
     @staticmethod
     def gpc_learning(X, Y, output_file=None):
+        from sklearn.gaussian_process import GaussianProcessClassifier
         gpc = GaussianProcessClassifier().fit(X, Y)
         if output_file is not None:
-            jl.dump(gpc, output_file)
+            jl.dump(gpc, output_file, **_DUMP_KW)
             logging.info('model file saved to %s' % output_file)
 
     @staticmethod
     def gaussian_nb(X, Y, output_file=None):
         gnb = GaussianNB().fit(X, Y)
         if output_file is not None:
-            jl.dump(gnb, output_file)
+            jl.dump(gnb, output_file, **_DUMP_KW)
             logging.info('model file saved to %s' % output_file)
 
     @staticmethod
@@ -128,7 +235,7 @@ class PhenomeLearners(object):
         logging.info(cls2label)
         kdt = KDTree(X)
         if output_file is not None:
-            jl.dump({'dbm': dbm, 'X': X, 'Y': Y, 'kdt': kdt, 'cls2label': cls2label}, output_file)
+            jl.dump({'dbm': dbm, 'X': X, 'Y': Y, 'kdt': kdt, 'cls2label': cls2label}, output_file, **_DUMP_KW)
             logging.info('complex model file saved to %s' % output_file)
 
     @staticmethod
@@ -139,7 +246,7 @@ class PhenomeLearners(object):
             logging.info('model file NOT FOUND: %s' % model_file)
             all_true = True
         else:
-            m = jl.load(model_file)
+            m = jl.load(model_file, **_LOAD_KW)
             dbm = m['dbm']
             kdt = m['kdt']
             P = m.predict(X)
@@ -149,7 +256,7 @@ class PhenomeLearners(object):
             if multiple_tps > 0:
                 performance.increase_true_positive(multiple_tps)
         if all_true or len(X) <= min_sample_size:
-            logging.warn('using querying instead of predicting')
+            logging.warning('using querying instead of predicting')
             P = numpy.ones(len(X))
         else:
             logging.info('instance size %s' % len(P))
@@ -160,7 +267,7 @@ class PhenomeLearners(object):
     def knn_classify(X, Y, output_file=None):
         knn = KNeighborsClassifier(n_neighbors=2).fit(X, Y)
         if output_file is not None:
-            jl.dump(knn, output_file)
+            jl.dump(knn, output_file, **_DUMP_KW)
             logging.info('model file saved to %s' % output_file)
 
     @staticmethod
@@ -201,13 +308,12 @@ class PhenomeLearners(object):
     def cal_performance(P, Y, performance, separate_performance=None,
                         id2conll=None, doc_anns=None, file_pattern=None, doc_folder=None, label_whitelist=None):
 
-        P = numpy.asarray(P).flatten().tolist()
-        Y = numpy.asarray(Y).flatten().tolist()
+        P = numpy.asarray(P).flatten()
+        Y = numpy.asarray(Y).flatten()
         doc2predicted = {}
-        for idx in range(len(P)):
-            LabelPerformance.evaluate_to_performance(P[idx], Y[idx], [performance, separate_performance])
-            if P[idx] == 1.0 and id2conll is not None and doc_anns is not None and doc_folder is not None:
-                PhenomeLearners.collect_prediction(P, doc_anns, doc2predicted)
+        LabelPerformance.evaluate_all_to_performance(P, Y, [performance, separate_performance])
+        if (P == 1.0).any() and id2conll is not None and doc_anns is not None and doc_folder is not None:
+            PhenomeLearners.collect_prediction(P, doc_anns, doc2predicted)
         # comment the following out to skip conll outputs
         # for d in doc2predicted:
         #     if d not in id2conll:
@@ -229,12 +335,11 @@ class PhenomeLearners(object):
             all_true = True
         else:
             if pca_model_file is not None:
-                pca = jl.load(pca_model_file)
+                pca = PhenomeLearners.load_model(pca_model_file)
                 X_new = pca.transform(X)
             else:
                 X_new = X
-            m = jl.load(model_file)
-            P = m.predict(X_new)
+            P = PhenomeLearners.model_predict(model_file, X_new)
             if fns > 0:
                 logging.debug('missed instances: %s' % fns)
                 performance.increase_false_negative(fns)
@@ -261,12 +366,11 @@ class PhenomeLearners(object):
             all_true = True
         else:
             if pca_model_file is not None:
-                pca = jl.load(pca_model_file)
+                pca = PhenomeLearners.load_model(pca_model_file)
                 X_new = pca.transform(X)
             else:
                 X_new = X
-            m = jl.load(model_file)
-            P = m.predict(X_new)
+            P = PhenomeLearners.model_predict(model_file, X_new)
 
         if all_true:  # or len(X) <= _min_sample_size:
             logging.warning('using querying instead of predicting')
@@ -293,6 +397,7 @@ class LabelPerformance(object):
     """
     precision/recall/f1 calculation on TP/FN/FP values
     """
+    __slots__ = ('_label', '_tp', '_fn', '_fp')
 
     def __init__(self, label):
         self._label = label
@@ -337,10 +442,11 @@ class LabelPerformance(object):
 
     @property
     def f1(self):
-        if self.precision == -1 or self.recall == -1 or self.precision == 0 or self.recall == 0:
+        # precision or recall being -1 or 0 all come down to no true positives
+        if self._tp == 0:
             return -1
         else:
-            return 2 / (1 / self.precision + 1 / self.recall)
+            return 2.0 * self._tp / (2 * self._tp + self._fp + self._fn)
 
     @staticmethod
     def evaluate_to_performance(predicted, labelled, performance_objects):
@@ -358,6 +464,23 @@ class LabelPerformance(object):
                 if pf is not None:
                     pf.increase_false_negative()
 
+    @staticmethod
+    def evaluate_all_to_performance(predicted, labelled, performance_objects):
+        """
+        evaluate_to_performance over arrays of predictions and labels, counting in one go
+        """
+        predicted = numpy.asarray(predicted)
+        labelled = numpy.asarray(labelled)
+        predicted_true = predicted == 1.0
+        tp = int(numpy.count_nonzero(predicted_true & (predicted == labelled)))
+        fp = int(numpy.count_nonzero(predicted_true & (predicted != labelled)))
+        fn = int(numpy.count_nonzero(~predicted_true & (predicted != labelled)))
+        for pf in performance_objects:
+            if pf is not None:
+                pf.increase_true_positive(tp)
+                pf.increase_false_positive(fp)
+                pf.increase_false_negative(fn)
+
 class BinaryClusterClassifier(object):
     def __init__(self, label):
         self._name = label
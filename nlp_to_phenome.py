@@ -7,9 +7,10 @@ using AI models to infer patient phenotypes from identified named entities (inst
 """
 import utils
 from os.path import basename, isfile, join
-from os import listdir
-import json
+from os import scandir, replace
 import logging
+import copy
+import joblib as jl
 from LabelModel import LabelModel
 import mention_pattern as mp
 from annotation_docs import SemEHRAnnDoc, CustomisedRecoginiser, Concept2Mapping
@@ -35,24 +36,45 @@ class StrokeSettings(object):
         return self._setting
 
 
-def extract_doc_level_ann(ann_dump, output_folder):
+def _list_files(folder):
+    """
+    names of the files in the folder, using the type info scandir already has instead of a stat per file
+    """
+    with scandir(folder) as it:
+        return [e.name for e in it if e.is_file()]
+
+
+def extract_doc_level_ann(ann_dump, output_folder, suffix=''):
     """
 
     extract doc level annotations and save to separate files
     :param ann_dump:
     :param output_folder:
-    :return:
+    :param suffix: appended to the name of every file saved
+    :return: the files saved, in the order first saved
     """
-    lines = utils.read_text_file(ann_dump)
-    for l in lines:
-        doc_ann = json.loads(l)
-        utils.save_string(l, join(output_folder, doc_ann['docId'].split('.')[0] + '.json'))
-
-
-def extract_all_doc_anns(dump_folder, output_folder):
-    dumps = [f for f in listdir(dump_folder) if isfile(join(dump_folder, f))]
-    for d in dumps:
-        extract_doc_level_ann(join(dump_folder, d), output_folder)
+    saved = {}
+    # streamed line by line, dumps can be much larger than memory
+    with open(ann_dump, 'rb', buffering=1 << 20) as rf:
+        for raw in rf:
+            raw = raw.strip()
+            doc_ann = utils.load_json_bytes(raw)
+            output_file = join(output_folder, doc_ann['docId'].split('.')[0] + '.json') + suffix
+            utils.save_string(raw.decode('utf-8'), output_file)
+            saved[output_file] = True
+    return list(saved)
+
+
+def extract_all_doc_anns(dump_folder, output_folder, n_jobs=-1):
+    dumps = _list_files(dump_folder)
+    # each dump is saved under its own suffix, so dumps holding the same doc never write the same file at once;
+    # the files are then renamed in dump order, the last dump wins as when the dumps were extracted one by one
+    suffixes = ['.%s.part' % i for i in range(len(dumps))]
+    for suffix, saved in zip(suffixes, jl.Parallel(n_jobs=n_jobs)(
+            jl.delayed(extract_doc_level_ann)(join(dump_folder, d), output_folder, suffix=suffix)
+            for d, suffix in zip(dumps, suffixes))):
+        for f in saved:
+            replace(f, f[:-len(suffix)])
 
 
 def save_full_text(xml_file, output_dir):
@@ -71,55 +93,72 @@ def save_full_text(xml_file, output_dir):
     utils.save_string(ed.get_full_text, join(output_dir, name))
 
 
-def process_files(read_dir, write_dir):
-    utils.multi_thread_process_files(read_dir, file_extension='xml', num_threads=10,
-                                     process_func=save_full_text, args=[write_dir])
+def try_save_full_text(xml_file, output_dir):
+    """
+    save_full_text that logs a failing file instead of raising, so one bad xml does not stop a batch
+    """
+    try:
+        save_full_text(xml_file, output_dir)
+    except Exception as e:
+        logging.error('error processing %s: %s' % (xml_file, e))
+
 
+def process_files(read_dir, write_dir, n_jobs=-1):
+    # xml parsing is cpu bound, run it in worker processes rather than threads
+    xml_files = [f for f in _list_files(read_dir) if f.endswith('.xml')]
+    jl.Parallel(n_jobs=n_jobs, batch_size=16)(jl.delayed(try_save_full_text)(join(read_dir, f), write_dir)
+                                              for f in xml_files)
 
-def get_doc_level_inference(label_dir, ann_dir, file_key, type2insts, type2inst_2, t2missed):
+
+def get_doc_level_inference(label_dir, ann_dir, file_key):
     """
     learn concept to label inference from gold standard - i.e. querying SemEHR annotations to
     draw conclusions
     :param label_dir:
     :param ann_dir:
     :param file_key:
-    :param type2insts:
-    :param type2inst_2:
-    :return:
+    :return: type2insts, type2inst_2 and t2missed of this doc, None if the label file does not exist
     """
     label_file = '%s-ann.xml' % file_key
     ann_file = '%s.json' % file_key
     logging.info('working on %s' % join(label_dir, label_file))
-    ed = EDIRDoc(join(label_dir, label_file))
     if not isfile(join(label_dir, label_file)):
         print('not a file: %s' % join(label_dir, label_file))
-        return
+        return None
+    ed = EDIRDoc(join(label_dir, label_file))
+    type2insts = {}
+    type2inst_2 = {}
+    t2missed = {}
     sd = SemEHRAnnDoc(join(ann_dir, ann_file))
     sd.learn_mappings_from_labelled(ed, type2insts, t2missed)
+    return type2insts, type2inst_2, t2missed
 
 
-def learn_concept_mappings(output_lst_folder):
+def learn_concept_mappings(output_lst_folder, n_jobs=-1):
     type2insts = {}
     type2insts_2 = {}
     label_dir = _gold_dir
     ann_dir = _ann_dir
-    file_keys = [f.split('.')[0] for f in listdir(ann_dir) if isfile(join(ann_dir, f))]
+    file_keys = [f.split('.')[0] for f in _list_files(ann_dir)]
     t2missed = {}
-    for fk in file_keys:
-        get_doc_level_inference(label_dir,
-                                ann_dir,
-                                fk,
-                                type2insts,
-                                type2insts_2,
-                                t2missed)
+    # docs are parsed in parallel, their findings merged in file order
+    for r in jl.Parallel(n_jobs=n_jobs)(jl.delayed(get_doc_level_inference)(label_dir, ann_dir, fk)
+                                        for fk in file_keys):
+        if r is None:
+            continue
+        for merged, doc_level in zip([type2insts, type2insts_2], r[:2]):
+            for t in doc_level:
+                merged.setdefault(t, set()).update(doc_level[t])
+        for t in r[2]:
+            t2missed.setdefault(t, []).extend(r[2][t])
     for t in type2insts:
         type2insts[t] = list(type2insts[t])
-    logging.info(json.dumps(type2insts))
+    logging.info(utils.dumps_json(type2insts))
 
     s = '\n' * 2
     for t in type2insts_2:
         type2insts_2[t] = list(type2insts_2[t])
-    s += json.dumps(type2insts_2)
+    s += utils.dumps_json(type2insts_2)
 
     s += '\n' * 2
     labels = []
@@ -131,7 +170,7 @@ def learn_concept_mappings(output_lst_folder):
         defs.append(t + '.lst' + ':StrokeStudy:' + t)
     s += '\n' * 2
     s += '\n'.join(defs)
-    s += json.dumps(t2missed)
+    s += utils.dumps_json(t2missed)
     logging.info(s)
 
 
@@ -142,15 +181,22 @@ def learn_prediction_model(label, ann_dir=None, gold_dir=None, model_file=None,
                            max_dimension=None,
                            ignore_mappings=[],
                            viz_file=None, ignore_context=False, separate_by_label=False, full_text_dir=None,
-                           eHostGD=False):
+                           eHostGD=False, collected_model=None):
+    """
+    :param collected_model: a LabelModel with its tfidf dimensions already collected from ann_dir/gold_dir
+    (see collect_label_model), a copy of it is used instead of collecting them again
+    """
     model_changed = False
     if model_file is not None:
         lm = LabelModel.deserialise(model_file)
+    elif collected_model is not None:
+        model_changed = True
+        # the copy keeps the selected dimensions of this run out of the shared model, the mapping is not copied
+        lm = copy.deepcopy(collected_model, {id(collected_model.concept_mapping): collected_model.concept_mapping})
     else:
         model_changed = True
-        lm = LabelModel(label, _cm_obj)
-        lm.collect_tfidf_dimensions(ann_dir=ann_dir, gold_dir=gold_dir, ignore_context=ignore_context,
-                                    separate_by_label=separate_by_label, full_text_dir=full_text_dir, eHostGD=eHostGD)
+        lm = collect_label_model(label, ann_dir, gold_dir, ignore_context=ignore_context,
+                                 separate_by_label=separate_by_label, full_text_dir=full_text_dir, eHostGD=eHostGD)
     lm.use_one_dimension_for_label = False
     lm.max_dimensions = max_dimension
     if ann_dir is not None:
@@ -183,6 +229,14 @@ def learn_prediction_model(label, ann_dir=None, gold_dir=None, model_file=None,
         logging.debug('%s.lm saved' % label)
 
 
+def collect_label_model(label, ann_dir, gold_dir, ignore_context=False, separate_by_label=False,
+                        full_text_dir=None, eHostGD=False):
+    lm = LabelModel(label, _cm_obj)
+    lm.collect_tfidf_dimensions(ann_dir=ann_dir, gold_dir=gold_dir, ignore_context=ignore_context,
+                                separate_by_label=separate_by_label, full_text_dir=full_text_dir, eHostGD=eHostGD)
+    return lm
+
+
 def predict_label(model_file, test_ann_dir, test_gold_dir, ml_model_file_ptn, performance,
                   pca_model_file=None,
                   max_dimension=None,
@@ -230,7 +284,8 @@ def predict_label(model_file, test_ann_dir, test_gold_dir, ml_model_file_ptn, pe
             if len(X) > 0:
                 logging.debug('predict data: %s, dimensions %s, insts %s' % (lbl, len(X[0]), len(X)))
             bc = lm.get_binary_cluster_classifier(lbl)
-            if bc is not None:
+            # the per instance cluster classification is only logged, skip it unless debugging
+            if bc is not None and logging.getLogger().isEnabledFor(logging.DEBUG):
                 complementary_classifiers = []
                 for l in lm.cluster_classifier_dict:
                     if l != lbl:
@@ -256,7 +311,7 @@ def escape_lable_to_filename(s):
     return s.replace('\\', '_').replace('/', '_')
 
 
-def populate_semehr_results(label_dir, ann_dir, file_key,
+def populate_semehr_results(label_dir, ann_dir, file_key, cm,
                             label2performances, using_combined=False):
     label_file = '%s-ann.xml' % file_key
     ann_file = '%s.json' % file_key
@@ -265,7 +320,6 @@ def populate_semehr_results(label_dir, ann_dir, file_key,
         return
 
     ed = EDIRDoc(join(label_dir, label_file))
-    cm = Concept2Mapping(_concept_mapping)
     cr = CustomisedRecoginiser(join(ann_dir, ann_file), cm)
     if using_combined:
         cr.validate_combined_performance(ed.get_ess_entities(), label2performances)
@@ -278,9 +332,11 @@ def populate_validation_results():
     ann_dir = _ann_dir
 
     label2performances = {}
-    file_keys = [f.split('.')[0] for f in listdir(ann_dir) if isfile(join(ann_dir, f))]
+    # the concept mapping is the same for every doc, load it once
+    cm = Concept2Mapping(_concept_mapping)
+    file_keys = [f.split('.')[0] for f in _list_files(ann_dir)]
     for fk in file_keys:
-        populate_semehr_results(label_dir, ann_dir, fk, label2performances, using_combined=False)
+        populate_semehr_results(label_dir, ann_dir, fk, cm, label2performances, using_combined=False)
     CustomisedRecoginiser.print_performances(label2performances)
 
 
@@ -302,6 +358,10 @@ def do_learn_exp(viz_file, num_dimensions=[20], ignore_context=False, separate_b
         # remove previous model files logging.debug('removing previously learnt models...') for f in [f for f in
         # listdir(_learning_model_dir) if isfile(join(_learning_model_dir, f)) and f.endswith('.model')]: remove(
         # join(_learning_model_dir, f))
+        # the tfidf statistics do not depend on the dimension setting, collect them once for the sweep
+        collected_model = collect_label_model(lbl, _ann_dir, _gold_dir, ignore_context=ignore_context,
+                                              separate_by_label=separate_by_label, full_text_dir=_gold_text_dir,
+                                              eHostGD=eHostGD)
         for dim in max_dimensions:
             logging.info('dimension setting: %s' % dim)
             learn_prediction_model(lbl,
@@ -317,7 +377,8 @@ def do_learn_exp(viz_file, num_dimensions=[20], ignore_context=False, separate_b
                                    ignore_context=ignore_context,
                                    separate_by_label=separate_by_label,
                                    full_text_dir=_gold_text_dir,
-                                   eHostGD=eHostGD)
+                                   eHostGD=eHostGD,
+                                   collected_model=collected_model)
             logging.debug('bad labels: %s' % ignore_mappings)
             pl = '%s dim[%s]' % (lbl, dim)
             performance = LabelPerformance(pl)
@@ -357,7 +418,7 @@ def merge_mappings_dictionary(map_files, dict_dirs, new_map_file, new_dict_folde
         new_m.update(m)
     t2list = {}
     for dd in dict_dirs:
-        lst_files = [f for f in listdir(dd) if isfile(join(dd, f)) and f.endswith('.lst')]
+        lst_files = [f for f in _list_files(dd) if f.endswith('.lst')]
         for f in lst_files:
             t = f[:f.index('.')]
             labels = utils.read_text_file(join(dd, f))
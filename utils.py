@@ -2,9 +2,31 @@ from os import listdir, rename
 from os.path import isfile, join, split
 import queue as Queue
 import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import json
 import codecs
 import requests
+import logging
+import multiprocessing
+try:
+    # C backed parser, several times faster than json on the SemEHR annotation files
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def init_worker_logging(level):
+    """
+    log to stderr at the caller's level in a joblib worker process, which does not inherit the logging setup;
+    a no-op when the task runs in the main process
+    """
+    if multiprocessing.current_process().name == 'MainProcess':
+        return
+    root = logging.getLogger()
+    if not root.handlers:
+        logging.basicConfig(format='[%(filename)s:%(lineno)d] %(name)s %(asctime)s %(message)s')
+    root.setLevel(level)
 
 
 # list files in a folder and put them in to a queue for multi-threading processing
@@ -115,7 +137,17 @@ def multi_thread_do(thread_obj, q, func, *args):
 
 def save_json_array(lst, file_path, encoding='utf-8'):
     with codecs.open(file_path, 'w', encoding=encoding) as wf:
-        json.dump(lst, wf)
+        wf.write(dumps_json(lst))
+
+
+def dumps_json(obj):
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj).decode('utf-8')
+        except TypeError:
+            # e.g. non string dict keys, leave those to json
+            pass
+    return json.dumps(obj)
 
 
 def save_string(txt, file_path, encoding='utf-8'):
@@ -124,10 +156,19 @@ def save_string(txt, file_path, encoding='utf-8'):
 
 
 def load_json_data(file_path):
-    data = None
-    with codecs.open(file_path, encoding='utf-8') as rf:
-        data = json.load(rf, encoding='utf-8')
-    return data
+    with open(file_path, 'rb') as rf:
+        raw = rf.read()
+    return load_json_bytes(raw)
+
+
+def load_json_bytes(raw):
+    if orjson is not None:
+        try:
+            return orjson.loads(raw)
+        except ValueError:
+            # orjson is strict (e.g. no NaN), leave such files to json
+            pass
+    return json.loads(raw.decode('utf-8'))
 
 
 def http_post_result(url, payload, headers=None, auth=None):
@@ -176,6 +217,23 @@ def multi_thread_large_file_tasking(large_file, num_threads, process_func,
         callback_func(*tuple(args))
 
 
+def read_binary_file(file_path):
+    with open(file_path, 'rb') as rf:
+        return rf.read()
+
+
+# read files ahead in a thread pool so that reading the next files overlaps with processing the current one
+def prefetch_files(file_paths, num_threads=8):
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        pending = deque()
+        for p in file_paths:
+            pending.append(executor.submit(read_binary_file, p))
+            if len(pending) > 2 * num_threads:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
+
+
 def read_text_file(file_path, encoding='utf-8'):
     lines = []
     with codecs.open(file_path, encoding=encoding) as rf: